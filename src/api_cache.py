@@ -4,29 +4,125 @@ Caching layer for AI API calls to avoid repeated expensive requests.
 Set DISABLE_API_CACHE=true to disable caching entirely.
 """
 
+import asyncio
 import base64
 import hashlib
 import json
+import random
+import shutil
+import weakref
+from io import BytesIO
 from pathlib import Path
 from typing import Any, Dict
 
 import aiohttp
 from litellm import (
+    APIConnectionError,
+    InternalServerError,
     ModelResponse,
+    RateLimitError,
+    ServiceUnavailableError,
 )
 from litellm import acompletion as _litellm_acompletion
 from litellm import completion as _litellm_completion
+from PIL import Image
+from pydantic_core import from_json, to_json
 from runware import IImageInference, Runware
 
-from constants import CACHE_DIR, DISABLE_CACHE, RUNWARE_API_KEY
+from constants import (
+    CACHE_DIR,
+    CLEAN_HTML_CACHE_DIR,
+    DISABLE_CACHE,
+    IMAGE_CONCURRENCY,
+    LLM_CONCURRENCY,
+    MAX_API_RETRIES,
+    NO_IMAGE_PLACEHOLDER,
+    RUNWARE_API_KEY,
+)
 
-# No global client - use separate connections for parallel processing
 
+class ImageClients:
+    """Runware connection and HTTP session shared across a batch of image generations.
+
+    Both are opened lazily on the first cache miss, so fully cached runs never connect.
+    They are scoped to a batch rather than global, as each batch may run in its own event loop.
+    """
+
+    def __init__(self):
+        self._runware: Runware | None = None
+        self._session: aiohttp.ClientSession | None = None
+        self._lock = asyncio.Lock()
+        # Caps the number of images generated at once
+        self.limit = asyncio.Semaphore(IMAGE_CONCURRENCY)
+
+    async def runware(self) -> Runware:
+        async with self._lock:
+            if self._runware is None:
+                runware = Runware(api_key=RUNWARE_API_KEY)
+                await runware.connect()
+                self._runware = runware
+        return self._runware
+
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None:
+            # Keep connections alive between downloads and cache DNS lookups
+            connector = aiohttp.TCPConnector(
+                limit=100, limit_per_host=20, keepalive_timeout=30, ttl_dns_cache=300
+            )
+            timeout = aiohttp.ClientTimeout(total=60, connect=10)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        try:
+            if self._runware is not None:
+                await self._runware.disconnect()
+        finally:
+            if self._session is not None:
+                await self._session.close()
 
-def _ensure_cache_dir():
-    """Ensure cache directory exists."""
-    if not DISABLE_CACHE:
-        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+# One semaphore per event loop, as each Streamlit run uses a fresh loop
+_llm_limits: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+
+
+def _llm_limit() -> asyncio.Semaphore:
+    """Semaphore capping the number of concurrent LLM calls in the running event loop."""
+    loop = asyncio.get_running_loop()
+    if loop not in _llm_limits:
+        _llm_limits[loop] = asyncio.Semaphore(LLM_CONCURRENCY)
+    return _llm_limits[loop]
+
+
+# Errors worth retrying: rate limits, overloaded servers and network failures
+_TRANSIENT_ERRORS = (
+    RateLimitError,
+    InternalServerError,
+    ServiceUnavailableError,
+    APIConnectionError,
+    aiohttp.ClientError,
+    asyncio.TimeoutError,
+)
+
+
+async def _with_retries(call, description: str, limit: asyncio.Semaphore):
+    """Await `call()`, retrying transient errors with exponential backoff and full jitter.
+
+    `limit` is only held during each attempt, so a call backing off leaves its slot to others.
+    """
+    for attempt in range(MAX_API_RETRIES):
+        try:
+            async with limit:
+                return await call()
+        except _TRANSIENT_ERRORS as e:
+            if attempt == MAX_API_RETRIES - 1:
+                raise
+            delay = random.uniform(0, min(60, 2**attempt))
+            print(f"⚠️ {description} failed ({type(e).__name__}), retrying in {delay:.1f}s")
+            await asyncio.sleep(delay)
 
 
 def _hash_request(func_name: str, *args, **kwargs) -> str:
@@ -36,12 +132,28 @@ def _hash_request(func_name: str, *args, **kwargs) -> str:
     return hashlib.sha256(request_str.encode()).hexdigest()[:16]
 
 
+def _cache_path(prefix: str, key: str) -> Path:
+    """Path of a cache entry, sharded by the first two hex chars of its key like git objects.
+
+    Entries written before sharding, directly in CACHE_DIR, are moved on first access.
+    """
+    cache_file = CACHE_DIR / key[:2] / f"{prefix}_{key}.json"
+    flat_file = CACHE_DIR / cache_file.name
+    if not DISABLE_CACHE and flat_file.exists() and not cache_file.exists():
+        try:
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            flat_file.rename(cache_file)
+        except OSError:
+            return flat_file
+    return cache_file
+
+
 def _load_cached_response(cache_file: Path) -> Dict[str, Any] | None:
     """Load cached response if it exists."""
     if cache_file.exists() and not DISABLE_CACHE:
         try:
-            return json.loads(cache_file.read_text())
-        except (json.JSONDecodeError, OSError):
+            return from_json(cache_file.read_bytes())
+        except (ValueError, OSError):
             # If cache file is corrupted, ignore it
             return None
     return None
@@ -50,18 +162,45 @@ def _load_cached_response(cache_file: Path) -> Dict[str, Any] | None:
 def _save_cached_response(cache_file: Path, response_data: Dict[str, Any]):
     """Save response to cache."""
     if not DISABLE_CACHE:
-        _ensure_cache_dir()
         try:
-            cache_file.write_text(json.dumps(response_data, indent=2, default=str))
+            cache_file.parent.mkdir(parents=True, exist_ok=True)
+            cache_file.write_bytes(to_json(response_data, fallback=str))
         except OSError:
             # If we can't write to cache, just continue without caching
             pass
 
 
+def _load_cached_image(cache_file: Path) -> str | None:
+    """Load a cached image, reading its base64 sidecar directly rather than parsing JSON."""
+    image_file = cache_file.with_suffix(".b64")
+    if image_file.exists() and not DISABLE_CACHE:
+        try:
+            return image_file.read_bytes().decode("ascii")
+        except (UnicodeDecodeError, OSError):
+            return None
+    # Entries cached before sidecars embed the image in the JSON itself
+    cached_data = _load_cached_response(cache_file)
+    return cached_data.get("output") if cached_data is not None else None
+
+
+def _save_cached_image(cache_file: Path, args: tuple, image_base64: str):
+    """Save an image to cache as a base64 sidecar next to a small JSON metadata stub."""
+    if not DISABLE_CACHE:
+        image_file = cache_file.with_suffix(".b64")
+        try:
+            image_file.parent.mkdir(parents=True, exist_ok=True)
+            image_file.write_bytes(image_base64.encode("ascii"))
+        except OSError:
+            return
+        _save_cached_response(
+            cache_file, {"args": args, "kwargs": {}, "output_file": image_file.name}
+        )
+
+
 def completion(*args, **kwargs):
     """Cached version of litellm.completion."""
     cache_key = _hash_request("completion", *args, **kwargs)
-    cache_file = CACHE_DIR / f"completion_{cache_key}.json"
+    cache_file = _cache_path("completion", cache_key)
 
     # Try to load from cache
     cached_data = _load_cached_response(cache_file)
@@ -83,7 +222,7 @@ def completion(*args, **kwargs):
 async def acompletion(*args, **kwargs):
     """Cached version of litellm.acompletion."""
     cache_key = _hash_request("acompletion", *args, **kwargs)
-    cache_file = CACHE_DIR / f"acompletion_{cache_key}.json"
+    cache_file = _cache_path("acompletion", cache_key)
 
     # Try to load from cache
     cached_data = _load_cached_response(cache_file)
@@ -93,7 +232,9 @@ async def acompletion(*args, **kwargs):
 
     # Make real API call
     print("🌐 Making fresh acompletion API call")
-    response = await _litellm_acompletion(*args, **kwargs)
+    response = await _with_retries(
+        lambda: _litellm_acompletion(*args, **kwargs), "acompletion API call", _llm_limit()
+    )
 
     # Cache the response
     cache_data = {"args": args, "kwargs": kwargs, "output": response.model_dump()}
@@ -103,22 +244,66 @@ async def acompletion(*args, **kwargs):
 
 
 async def generate_single_image_async(
-    prompt: str, image_size: tuple[int, int], runware_model: str
+    prompt: str,
+    image_size: tuple[int, int],
+    runware_model: str,
+    clients: ImageClients | None = None,
 ) -> str:
-    """Cached version of image generation."""
+    """Cached version of image generation.
+
+    Pass the same `clients` to every call of a batch to reuse one Runware connection
+    and one HTTP session. Without it, the call opens its own.
+    """
+    if clients is None:
+        async with ImageClients() as own_clients:
+            return await generate_single_image_async(prompt, image_size, runware_model, own_clients)
 
     # Create cache key from request parameters
     cache_key = _hash_request("generate_image", prompt, image_size, runware_model)
-    cache_file = CACHE_DIR / f"image_{cache_key}.json"
+    cache_file = _cache_path("image", cache_key)
 
     # Try to load from cache
-    cached_data = _load_cached_response(cache_file)
-    if cached_data is not None:
-        return cached_data["output"]
+    cached_image = _load_cached_image(cache_file)
+    if cached_image is not None:
+        return cached_image
+
+    # Make real API call over the shared connection, with a bounded number in flight.
+    # Inference and download are retried separately, so a failed download never pays for
+    # a second inference
+    image_url = await _with_retries(
+        lambda: _infer_image(prompt, image_size, runware_model, clients),
+        "Image generation",
+        clients.limit,
+    )
+    content = None
+    if image_url is not None:
+        content = await _with_retries(
+            lambda: _download_image(image_url, clients), "Image download", clients.limit
+        )
+
+    if content is None:
+        return NO_IMAGE_PLACEHOLDER
+
+    # Runware already sends WebP, so the image is cached as downloaded. Checking it and
+    # writing it are CPU and disk bound, keep them off the event loop
+    if not await asyncio.to_thread(_is_image, content):
+        print("⚠️ Image download is not a readable image, skipping it")
+        return NO_IMAGE_PLACEHOLDER
+    image_base64 = base64.b64encode(content).decode("ascii")
+
+    # Cache the response
+    await asyncio.to_thread(
+        _save_cached_image, cache_file, (prompt, image_size, runware_model), image_base64
+    )
+
+    return image_base64
 
-    # Make real API call with dedicated connection for parallel processing
-    runware = Runware(api_key=RUNWARE_API_KEY)
-    await runware.connect()
+
+async def _infer_image(
+    prompt: str, image_size: tuple[int, int], runware_model: str, clients: ImageClients
+) -> str | None:
+    """Generate an image with Runware. Returns its URL, or None on failure."""
+    runware = await clients.runware()
 
     request_image = IImageInference(
         positivePrompt=prompt,
@@ -127,51 +312,75 @@ async def generate_single_image_async(
         negativePrompt="Text, label, diagram, blurry, low quality, distorted",
         height=image_size[0],
         width=image_size[1],
+        # Several times smaller than the default JPG for illustrations
+        outputFormat="WEBP",
     )
 
     images = await runware.imageInference(requestImage=request_image)
+    if not images:
+        return None
+    return images[0].imageURL
+
+
+async def _download_image(image_url: str, clients: ImageClients) -> bytes | None:
+    """Download a generated image. Returns None on failure."""
+    async with clients.session().get(image_url) as response:
+        if response.status >= 500:
+            # Server errors are transient, let the caller retry
+            response.raise_for_status()
+        if response.status != 200:
+            return None
+        return await response.read()
 
-    if images:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(images[0].imageURL) as response:
-                if response.status == 200:
-                    content = await response.read()
-                    image_base64 = base64.b64encode(content).decode("utf-8")
-
-                    # Cache the response
-                    cache_data = {
-                        "args": (prompt, image_size, runware_model),
-                        "kwargs": {},
-                        "output": image_base64,
-                    }
-                    _save_cached_response(cache_file, cache_data)
-
-                    return image_base64
 
-    return "No image generated"
+def _is_image(image_bytes: bytes) -> bool:
+    """Whether PIL can read the bytes as an image, checked without decoding the pixels."""
+    try:
+        with Image.open(BytesIO(image_bytes)) as image:
+            image.verify()
+    except (OSError, SyntaxError):
+        # OSError includes PIL.UnidentifiedImageError
+        return False
+    return True
 
 
 def get_cache_stats() -> Dict[str, int]:
-    """Get statistics about cached responses."""
-    if DISABLE_CACHE or not CACHE_DIR.exists():
-        return {"total_cached": 0, "completions": 0, "images": 0}
-
-    completion_files = len(list(CACHE_DIR.glob("completion_*.json")))
-    acompletion_files = len(list(CACHE_DIR.glob("acompletion_*.json")))
-    image_files = len(list(CACHE_DIR.glob("image_*.json")))
+    """Get statistics about cached responses, and the cleaned HTML of converted EPUBs."""
+    if DISABLE_CACHE:
+        return {"total_cached": 0, "completions": 0, "images": 0, "clean_html": 0}
+
+    completion_files = len(list(CACHE_DIR.rglob("completion_*.json")))
+    acompletion_files = len(list(CACHE_DIR.rglob("acompletion_*.json")))
+    image_files = len(list(CACHE_DIR.rglob("image_*.json")))
+    # One directory per converted EPUB, skipping conversions still being staged
+    clean_html_entries = 0
+    if CLEAN_HTML_CACHE_DIR.exists():
+        clean_html_entries = sum(
+            1
+            for entry in CLEAN_HTML_CACHE_DIR.iterdir()
+            if entry.is_dir() and not entry.name.startswith(".")
+        )
 
     return {
-        "total_cached": completion_files + acompletion_files + image_files,
+        "total_cached": completion_files + acompletion_files + image_files + clean_html_entries,
         "completions": completion_files + acompletion_files,
         "images": image_files,
+        "clean_html": clean_html_entries,
     }
 
 
 def clear_cache():
-    """Clear all cached responses."""
+    """Clear all cached responses, and the cleaned HTML of converted EPUBs."""
+    if not CACHE_DIR.exists() and not CLEAN_HTML_CACHE_DIR.exists():
+        print("🧹 No cache to clear")
+        return
+
     if CACHE_DIR.exists():
-        for cache_file in CACHE_DIR.glob("*.json"):
+        for cache_file in [*CACHE_DIR.rglob("*.json"), *CACHE_DIR.rglob("*.b64")]:
             cache_file.unlink()
-        print("🧹 Cleared API cache")
-    else:
-        print("🧹 No cache to clear")
+        for shard in CACHE_DIR.iterdir():
+            if shard.is_dir() and not any(shard.iterdir()):
+                shard.rmdir()
+    # Holds nothing but cache entries, so it goes as a whole
+    shutil.rmtree(CLEAN_HTML_CACHE_DIR, ignore_errors=True)
+    print("🧹 Cleared API cache")
@@ -1,16 +1,19 @@
 import asyncio
-import json
+import base64
+import re
 import warnings
 from pathlib import Path
 
 from pydantic import BaseModel, Field
+from pydantic_core import to_json
 
-from api_cache import acompletion, completion, generate_single_image_async
+from api_cache import ImageClients, acompletion, completion, generate_single_image_async
 from constants import (
     CARD_IMAGE_SIZE,
     CONCEPT_CARD_RATIO,
     LANDSCAPE_IMAGE_SIZE,
     MODEL_NAME,
+    NO_IMAGE_PLACEHOLDER,
     RUNWARE_MODEL,
 )
 from prompts.card_creation import (
@@ -20,6 +23,8 @@ from prompts.card_creation import (
     STYLE_PROMPT,
 )
 
+_TAG_ID_PATTERN = re.compile(r'id="(tag-\d+)"')
+
 
 # Data models
 class SectionColor(BaseModel):
@@ -137,25 +142,19 @@ def analyze_book_structure(book_html: str) -> BookStructure:
     book_structure = BookStructure.model_validate_json(result.choices[0].message.content)
 
     # Process passages by extracting content between tags
+    tag_index = _build_tag_index(book_html)
     for section in book_structure.sections:
         for passage in section.key_passages:
-            start_tag = f'id="{passage.passage_start_tag}"'
-            end_tag = f'id="{passage.passage_end_tag}"'
-
-            start_idx = book_html.find(start_tag)
-            end_idx = book_html.find(end_tag)
+            start_idx = tag_index.get(passage.passage_start_tag, -1)
+            end_idx = tag_index.get(passage.passage_end_tag, -1)
 
             if start_idx == -1 or end_idx == -1:
                 print(f"Warning: Could not find tags for passage in section {section.section_name}")
                 continue
 
-            # Find the previous < before the start tag
-            while start_idx > 0 and book_html[start_idx] != "<":
-                start_idx -= 1
-
-            # Find the previous < before the end tag
-            while end_idx > 0 and book_html[end_idx] != "<":
-                end_idx -= 1
+            # Extend both tags back to their opening <
+            start_idx = _find_tag_start(book_html, start_idx)
+            end_idx = _find_tag_start(book_html, end_idx)
 
             passage.passage_post_process = book_html[start_idx:end_idx]
 
@@ -196,46 +195,73 @@ async def generate_images_for_game(
     cards: CardSet, book_structure: BookStructure
 ) -> tuple[CardSet, BookStructure]:
     """Generate images for cards and landscape sections, adding visual styles to cards."""
-    # Add visual styles to card illustrations
-    _add_visual_styles_to_cards(cards)
+    # Landscapes don't depend on the styles, so they are generated while the styles are written
+    async with ImageClients() as clients:
+        await asyncio.gather(
+            generate_card_images(cards, clients),
+            generate_landscape_images(book_structure, clients),
+        )
+
+    print(
+        f"Generated {len(cards.card_definitions)} card images and {len(book_structure.sections)} landscape images"
+    )
+    return cards, book_structure
+
+
+async def generate_card_images(cards: CardSet, clients: ImageClients | None = None) -> CardSet:
+    """Add visual styles to card illustrations, then generate the card images."""
+    await _add_visual_styles_to_cards(cards)
 
-    # Generate card images and landscape images concurrently
     card_prompts = [card.illustration for card in cards.card_definitions]
+    card_images = await _generate_images_async(card_prompts, CARD_IMAGE_SIZE, clients)
+
+    for card, image_base64 in zip(cards.card_definitions, card_images):
+        card.image_base64 = image_base64
+    return cards
+
+
+async def generate_landscape_images(
+    book_structure: BookStructure, clients: ImageClients | None = None
+) -> BookStructure:
+    """Generate the landscape image of each section.
+
+    Only the book structure is needed, so this can run while the cards are being generated.
+    """
     landscape_prompts = [
         section.visual_landscape_description for section in book_structure.sections
     ]
-
-    card_images, landscape_images = await asyncio.gather(
-        _generate_images_async(card_prompts, CARD_IMAGE_SIZE),
-        _generate_images_async(landscape_prompts, LANDSCAPE_IMAGE_SIZE),
+    landscape_images = await _generate_images_async(
+        landscape_prompts, LANDSCAPE_IMAGE_SIZE, clients
     )
 
-    # Assign images to cards and sections
-    for card, image_base64 in zip(cards.card_definitions, card_images):
-        card.image_base64 = image_base64
-
     for section, image_base64 in zip(book_structure.sections, landscape_images):
         section.image_base64 = image_base64
-
-    print(
-        f"Generated {len(cards.card_definitions)} card images and {len(book_structure.sections)} landscape images"
-    )
-    return cards, book_structure
+    return book_structure
 
 
 def save_game_data(cards: CardSet, book_structure: BookStructure, filename: Path):
-    """Save cards as JSONL and book structure as JSON."""
-    # Save cards with images as JSONL
+    """Save cards as JSONL and book structure as JSON.
+
+    Card images are written as image files next to the JSONL, which references them by
+    a path relative to its own directory.
+    """
+    # Save cards as JSONL, with images as sidecar files
     cards_file = filename.with_suffix(".jsonl")
-    with cards_file.open("w") as f:
-        for card in cards.card_definitions:
-            card_dict = card.model_dump()
-            f.write(json.dumps(card_dict) + "\n")
+    images_dir = cards_file.with_name(f"{cards_file.stem}_images")
+    with cards_file.open("wb") as f:
+        for i, card in enumerate(cards.card_definitions):
+            card_dict = card.model_dump(exclude={"image_base64"})
+            if card.image_base64 and card.image_base64 != NO_IMAGE_PLACEHOLDER:
+                images_dir.mkdir(exist_ok=True)
+                image_bytes = base64.b64decode(card.image_base64)
+                image_file = images_dir / f"card_{i:03d}{_image_suffix(image_bytes)}"
+                image_file.write_bytes(image_bytes)
+                card_dict["image_path"] = str(image_file.relative_to(cards_file.parent))
+            f.write(to_json(card_dict) + b"\n")
 
     # Save book structure as JSON
     structure_file = filename.with_suffix(".json")
-    with structure_file.open("w") as f:
-        json.dump(book_structure.model_dump(), f, indent=2)
+    structure_file.write_bytes(to_json(book_structure, indent=2))
 
     print(f"Saved {len(cards.card_definitions)} cards to {cards_file}")
     print(f"Saved book structure to {structure_file}")
@@ -308,41 +334,68 @@ async def generate_section_cards_async(section_text: str, num_cards: int) -> Car
 def _split_book_into_sections(book_html: str, book_structure: BookStructure) -> list[str]:
     """Split book HTML into section texts based on chapter boundaries."""
     sections = []
+    tag_index = _build_tag_index(book_html)
 
     for section in book_structure.sections:
         first_chapter = section.chapters[0]
         last_chapter = section.chapters[-1]
 
-        start_tag = f'id="{first_chapter.chapter_start_tag}"'
         end_tag = f'id="{last_chapter.chapter_end_tag}"'
 
-        start_idx = book_html.find(start_tag)
-        end_idx = book_html.find(end_tag) + len(end_tag)
+        start_idx = tag_index.get(first_chapter.chapter_start_tag, -1)
+        end_idx = tag_index.get(last_chapter.chapter_end_tag, -1)
 
-        if start_idx == -1 or end_idx == -1:
+        if start_idx == -1 or end_idx < start_idx:
             raise ValueError(f"Could not find chapter tags for section {section.section_name}")
 
-        section_text = book_html[start_idx:end_idx]
+        section_text = book_html[start_idx : end_idx + len(end_tag)]
         sections.append(section_text)
 
     return sections
 
 
+def _build_tag_index(book_html: str) -> dict[str, int]:
+    """Map each tag id added by clean_epub to the position of its first id="..." attribute."""
+    tag_index = {}
+    for match in _TAG_ID_PATTERN.finditer(book_html):
+        tag_index.setdefault(match.group(1), match.start())
+    return tag_index
+
+
+def _image_suffix(image_bytes: bytes) -> str:
+    """File extension of an image from its signature.
+
+    Images are generated as WebP, older cache entries hold the JPG or PNG Runware sent.
+    """
+    if image_bytes[:4] == b"RIFF" and image_bytes[8:12] == b"WEBP":
+        return ".webp"
+    if image_bytes[:3] == b"\xff\xd8\xff":
+        return ".jpg"
+    return ".png"
+
+
+def _find_tag_start(book_html: str, idx: int) -> int:
+    """Return the position of the last < at or before idx, or 0 if there is none."""
+    return max(book_html.rfind("<", 0, idx + 1), 0)
+
+
 def _calculate_cards_per_section(sections: list[str], total_cards: int) -> list[int]:
     """Calculate proportional card distribution based on section text length."""
     total_chars = sum(len(section) for section in sections)
     return [int(total_cards * len(section) / total_chars) for section in sections]
 
 
-def _add_visual_styles_to_cards(cards: CardSet):
+async def _add_visual_styles_to_cards(cards: CardSet):
     """Add visual style instructions to card illustrations using AI."""
     cards_text = "\n\n----\n\n".join(
-        [f"CARD #{i}\n{card}" for i, card in enumerate(cards.card_definitions)]
+        f"CARD #{i}\n{card.model_dump_json(exclude={'image_base64'})}"
+        for i, card in enumerate(cards.card_definitions)
     )
 
     prompt = STYLE_PROMPT.format(CARDS=cards_text, NB_CARD=len(cards.card_definitions))
 
-    response = completion(
+    # The API cache key includes the exact prompt
+    response = await acompletion(
         model=MODEL_NAME,
         messages=[{"role": "user", "content": prompt}],
         response_format=StyleList,
@@ -355,7 +408,19 @@ def _add_visual_styles_to_cards(cards: CardSet):
         card.illustration += f" {style}"
 
 
-async def _generate_images_async(prompts: list[str], image_size: tuple[int, int]) -> list[str]:
+async def _generate_images_async(
+    prompts: list[str], image_size: tuple[int, int], clients: ImageClients | None = None
+) -> list[str]:
     """Generate images for a list of prompts using Runware API."""
-    tasks = [generate_single_image_async(prompt, image_size, RUNWARE_MODEL) for prompt in prompts]
-    return await asyncio.gather(*tasks)
+    if clients is None:
+        async with ImageClients() as own_clients:
+            return await _generate_images_async(prompts, image_size, own_clients)
+
+    # Identical prompts are generated only once
+    unique_prompts = list(dict.fromkeys(prompts))
+    tasks = [
+        generate_single_image_async(prompt, image_size, RUNWARE_MODEL, clients)
+        for prompt in unique_prompts
+    ]
+    images = dict(zip(unique_prompts, await asyncio.gather(*tasks)))
+    return [images[prompt] for prompt in prompts]
@@ -5,9 +5,9 @@ CLI tool for managing API cache.
 
 import typer
 
-from api_cache import CACHE_DIR, DISABLE_CACHE, clear_cache, get_cache_stats
+from api_cache import CACHE_DIR, CLEAN_HTML_CACHE_DIR, DISABLE_CACHE, clear_cache, get_cache_stats
 
-app = typer.Typer(help="Manage API response cache")
+app = typer.Typer(help="Manage API response cache, and the cleaned HTML of converted EPUBs")
 
 
 @app.command()
@@ -19,10 +19,11 @@ def stats():
 
     stats = get_cache_stats()
     typer.echo("📊 Cache Statistics:")
-    typer.echo(f"   Location: {CACHE_DIR}")
+    typer.echo(f"   Location: {CACHE_DIR}, {CLEAN_HTML_CACHE_DIR}")
     typer.echo(f"   Total cached responses: {stats['total_cached']}")
     typer.echo(f"   AI completions: {stats['completions']}")
     typer.echo(f"   Images: {stats['images']}")
+    typer.echo(f"   Cleaned EPUBs: {stats['clean_html']}")
 
 
 @app.command()
@@ -32,7 +33,9 @@ def clear():
         typer.echo("🚫 Cache is disabled (DISABLE_API_CACHE=true)")
         return
 
-    confirm = typer.confirm("Are you sure you want to clear all cached API responses?")
+    confirm = typer.confirm(
+        "Are you sure you want to clear all cached API responses and cleaned EPUBs?"
+    )
     if confirm:
         clear_cache()
     else:
@@ -43,6 +46,7 @@ def clear():
 def location():
     """Show cache directory location."""
     typer.echo(f"📁 Cache directory: {CACHE_DIR.absolute()}")
+    typer.echo(f"📁 Cleaned EPUB directory: {CLEAN_HTML_CACHE_DIR.absolute()}")
     if DISABLE_CACHE:
         typer.echo("🚫 Cache is currently disabled (DISABLE_API_CACHE=true)")
 
@@ -1,13 +1,39 @@
+import functools
+import hashlib
+import itertools
+import os
 import re
+import shutil
 import subprocess
+import tempfile
 from pathlib import Path
 
 import typer
 
-from constants import LUA_FILTER_FILENAME
+from constants import CLEAN_HTML_CACHE_DIR, DISABLE_CACHE, LUA_FILTER_FILENAME
 
 app = typer.Typer()
 
+_LUA_FILTER_PATH = Path(__file__).parent.resolve() / LUA_FILTER_FILENAME
+
+# Each HTML cache entry is a directory holding the cleaned HTML and the extracted media
+_CACHED_HTML_NAME = "clean.html"
+_CACHED_MEDIA_NAME = "media"
+
+# Image src="any/path/to/image.ext", with forward or backslashes for cross-platform compatibility
+_IMAGE_SRC_PATTERN = re.compile(
+    r'src="([^"]*[/\\])?([^"]*\.(png|jpg|jpeg|gif|svg|webp))"', re.IGNORECASE
+)
+# Img tags with any amount of whitespace/newlines
+_IMG_TAG_PATTERN = re.compile(r"<img\s+([^>]*?)>", re.DOTALL)
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+# Span tags that contain only whitespace (or nothing) between opening and closing tags
+_EMPTY_SPAN_PATTERN = re.compile(r"<span[^>]*>\s*</span>", re.IGNORECASE)
+# [\s\n]+ -> one or more whitespace or newlines before
+_HREF_ID_PATTERN = re.compile(r'[\s\n]+(href|id)="[^"]*"', re.IGNORECASE)
+# Any opening HTML tag, with or without attributes
+_OPENING_TAG_PATTERN = re.compile(r"(<\w+)([\s>])")
+
 
 def normalize_image_paths(html_content: str) -> str:
     """
@@ -18,16 +44,8 @@ def normalize_image_paths(html_content: str) -> str:
     strips all directory paths, keeping only filenames for deterministic output.
     """
 
-    def replace_img_src(match):
-        # Extract just the filename from the path
-        full_path = match.group(1)
-        filename = Path(full_path).name
-        return f'src="{filename}"'
-
     # Replace src="any/path/to/image.ext" with src="image.ext"
-    # Handles both forward and backslashes for cross-platform compatibility
-    pattern = r'src="([^"]*[/\\])?([^"]*\.(png|jpg|jpeg|gif|svg|webp))"'
-    return re.sub(pattern, r'src="\2"', html_content, flags=re.IGNORECASE)
+    return _IMAGE_SRC_PATTERN.sub(r'src="\2"', html_content)
 
 
 def normalize_img_tag_whitespace(html_content: str) -> str:
@@ -39,17 +57,15 @@ def normalize_img_tag_whitespace(html_content: str) -> str:
     different HTML formatting, breaking determinism used for caching. We normalize all whitespace
     within img tags to single spaces.
     """
-    # Pattern to match img tags with any amount of whitespace/newlines
-    pattern = r"<img\s+([^>]*?)>"
 
     def replace_img_tag(match):
         # Get all attributes and normalize whitespace between them
         attrs = match.group(1)
         # Replace any sequence of whitespace (including newlines) with single spaces
-        attrs = re.sub(r"\s+", " ", attrs.strip())
+        attrs = _WHITESPACE_PATTERN.sub(" ", attrs.strip())
         return f"<img {attrs}>"
 
-    return re.sub(pattern, replace_img_tag, html_content, flags=re.DOTALL)
+    return _IMG_TAG_PATTERN.sub(replace_img_tag, html_content)
 
 
 def remove_empty_spans(html_content: str) -> str:
@@ -59,35 +75,27 @@ def remove_empty_spans(html_content: str) -> str:
     These are often anchor links or references from EPUB that clutter the HTML.
     Handles spans with any attributes (including multiple id attributes).
     """
-    # Match span tags that contain only whitespace (or nothing) between opening and closing tags
     # This handles spans with any attributes, including malformed ones with duplicate ids
-    pattern = r"<span[^>]*>\s*</span>"
-    return re.sub(pattern, "", html_content, flags=re.IGNORECASE)
+    return _EMPTY_SPAN_PATTERN.sub("", html_content)
 
 
 def remove_href_and_id_attributes(html_content: str) -> str:
     """
     Remove href and id attributes from all elements.
     """
-    # [\s\n]+ -> one or more whitespace or newlines before
-    pattern = r'[\s\n]+(href|id)="[^"]*"'
-    return re.sub(pattern, "", html_content, flags=re.IGNORECASE)
+    return _HREF_ID_PATTERN.sub("", html_content)
 
 
 def add_unique_ids(html_content: str) -> str:
     """Add unique IDs to all HTML elements."""
-    id_counter = 0
+    next_id = itertools.count(1).__next__
 
     def replace_tag(match):
-        nonlocal id_counter
-        id_counter += 1
+        tag, end = match.groups()
         # If there's whitespace after the tag name, keep it, otherwise add a space
-        end = match.group(2) or " "
-        return f'{match.group(1)} id="tag-{id_counter}"{end}'
+        return f'{tag} id="tag-{next_id()}"{end or " "}'
 
-    # Match any opening HTML tag, with or without attributes
-    pattern = r"(<\w+)([\s>])"
-    return re.sub(pattern, replace_tag, html_content)
+    return _OPENING_TAG_PATTERN.sub(replace_tag, html_content)
 
 
 def convert_epub_to_html(
@@ -106,9 +114,6 @@ def convert_epub_to_html(
     Returns:
         Path to the generated HTML file
     """
-    script_dir = Path(__file__).parent.resolve()
-    lua_filter_path = script_dir / LUA_FILTER_FILENAME
-
     # Set defaults if not provided
     if output_html is None:
         output_html = input_epub.with_suffix(".html")
@@ -119,28 +124,128 @@ def convert_epub_to_html(
     # Ensure extract_media_dir exists
     extract_media_dir.mkdir(parents=True, exist_ok=True)
 
-    # Run pandoc conversion
+    # Reuse the result of converting the same EPUB before, skipping pandoc and the cleanup.
+    # An entry missing its HTML or media is treated as a miss
+    entry_dir = None
+    if not DISABLE_CACHE:
+        entry_dir = CLEAN_HTML_CACHE_DIR / _hash_conversion(input_epub)
+        if _is_complete_entry(entry_dir) and _link_media(
+            entry_dir / _CACHED_MEDIA_NAME, extract_media_dir
+        ):
+            try:
+                shutil.copyfile(entry_dir / _CACHED_HTML_NAME, output_html)
+                return output_html
+            except FileNotFoundError:
+                # The entry was removed after its media was linked, convert afresh
+                pass
+
+    # When caching, pandoc runs in a staging entry that replaces entry_dir in a single rename
+    # once complete, so no run ever sees a partial entry. extract_media_dir hard links to its
+    # media, so pandoc never writes through a link into a cache entry
+    staging_dir = None
+    pandoc_media_dir = extract_media_dir
+    if entry_dir is not None:
+        try:
+            CLEAN_HTML_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+            staging_dir = Path(tempfile.mkdtemp(prefix=".staging_", dir=CLEAN_HTML_CACHE_DIR))
+            pandoc_media_dir = staging_dir / _CACHED_MEDIA_NAME
+        except OSError:
+            # If we can't write to cache, just continue without caching
+            pass
+
+    # Run pandoc conversion, reading the HTML from its stdout to write it only once cleaned
     pandoc_command = [
         "pandoc",
         str(input_epub),
-        "-o",
-        str(output_html),
+        "--to=html",
         "--standalone",
         "--extract-media",
-        str(extract_media_dir),
-        f"--lua-filter={lua_filter_path}",
+        str(pandoc_media_dir),
+        f"--lua-filter={_LUA_FILTER_PATH}",
     ]
 
-    subprocess.run(pandoc_command, check=True, text=True)
-
-    # Post-process the HTML to ensure deterministic output
-    html_content = output_html.read_text(encoding="utf-8")
-    html_content = convert_html_to_clean_html(html_content)
-    output_html.write_text(html_content, encoding="utf-8")
+    try:
+        result = subprocess.run(
+            pandoc_command, check=True, stdout=subprocess.PIPE, encoding="utf-8"
+        )
+
+        # Post-process the HTML to ensure deterministic output
+        html_content = convert_html_to_clean_html(result.stdout)
+        output_html.write_text(html_content, encoding="utf-8")
+
+        if staging_dir is not None:
+            # Pandoc only creates the media directory for EPUBs with media
+            pandoc_media_dir.mkdir(exist_ok=True)
+            _link_media(pandoc_media_dir, extract_media_dir)
+            try:
+                shutil.copyfile(output_html, staging_dir / _CACHED_HTML_NAME)
+                # Only an entry edited by hand can be partial, replace it
+                if entry_dir.exists() and not _is_complete_entry(entry_dir):
+                    shutil.rmtree(entry_dir)
+                # Fails if another run of the same EPUB promoted its entry first, which is kept
+                os.replace(staging_dir, entry_dir)
+            except OSError:
+                pass
+    finally:
+        if staging_dir is not None:
+            shutil.rmtree(staging_dir, ignore_errors=True)
 
     return output_html
 
 
+def _is_complete_entry(entry_dir: Path) -> bool:
+    """Whether an HTML cache entry holds both the cleaned HTML and the media directory."""
+    return (entry_dir / _CACHED_HTML_NAME).is_file() and (entry_dir / _CACHED_MEDIA_NAME).is_dir()
+
+
+def _link_media(cached_media_dir: Path, extract_media_dir: Path) -> bool:
+    """Populate extract_media_dir with hard links to cached media, copying where linking fails.
+
+    Returns False if cached_media_dir is missing or loses files while being linked, which
+    happens when the cache is cleared meanwhile.
+    """
+
+    def link_or_copy(src: str, dst: Path) -> None:
+        if os.path.lexists(dst):
+            os.unlink(dst)
+        try:
+            os.link(src, dst)
+        except OSError:
+            # Hard links can't cross filesystems
+            shutil.copy2(src, dst)
+
+    def raise_error(error: OSError) -> None:
+        raise error
+
+    try:
+        for root, _, files in os.walk(cached_media_dir, onerror=raise_error):
+            target_dir = extract_media_dir / Path(root).relative_to(cached_media_dir)
+            target_dir.mkdir(parents=True, exist_ok=True)
+            for name in files:
+                link_or_copy(os.path.join(root, name), target_dir / name)
+    except FileNotFoundError:
+        return False
+    return True
+
+
+def _hash_conversion(input_epub: Path) -> str:
+    """Hash of everything the cleaned HTML of an EPUB depends on, keying the HTML cache.
+
+    This covers the EPUB, the pandoc version, the Lua filter and this module's cleanup code.
+    """
+    digest = hashlib.blake2b(input_epub.read_bytes(), digest_size=16)
+    digest.update(_pandoc_version())
+    digest.update(_LUA_FILTER_PATH.read_bytes())
+    digest.update(Path(__file__).read_bytes())
+    return digest.hexdigest()
+
+
+@functools.cache
+def _pandoc_version() -> bytes:
+    """Output of pandoc --version, run once per process."""
+    return subprocess.run(["pandoc", "--version"], check=True, stdout=subprocess.PIPE).stdout
+
+
 def convert_html_to_clean_html(html: str) -> str:
     """
     Clean an HTML file, removing footnotes, id/hrefs, adding unique IDs to all HTML elements.
@@ -7,10 +7,14 @@ from pathlib import Path
 MODEL_NAME = os.getenv("BB_MODEL", "gemini/gemini-2.5-flash")
 RUNWARE_MODEL = "runware:101@1"
 RUNWARE_API_KEY = os.getenv("RUNWARE_API_KEY")
+LLM_CONCURRENCY = int(os.getenv("BB_LLM_CONCURRENCY", "8"))  # Max LLM calls in flight at once
+MAX_API_RETRIES = 6  # Attempts for LLM and image calls failing with transient errors
 
 # Image generation configuration
 CARD_IMAGE_SIZE = (768, 384)
 LANDSCAPE_IMAGE_SIZE = (384, 640)
+NO_IMAGE_PLACEHOLDER = "No image generated"
+IMAGE_CONCURRENCY = int(os.getenv("BB_IMAGE_CONCURRENCY", "8"))  # Max images generated at once
 
 # Card generation configuration
 CONCEPT_CARD_RATIO = 0.7  # 70% concept cards, 30% example cards
@@ -21,6 +25,7 @@ DISABLE_CACHE = os.getenv("DISABLE_API_CACHE", "false").lower() == "true"
 
 # EPUB processing configuration
 LUA_FILTER_FILENAME = "remove_footnotes.lua"
+CLEAN_HTML_CACHE_DIR = Path("cache/clean_html")  # Cleaned HTML and media of converted EPUBs
 
 # Template configuration
 TEMPLATE_DIR = Path(__file__).resolve().parent / "templates"
@@ -1,9 +1,9 @@
-import os
+import subprocess
 from pathlib import Path
 
 import typer
 
-from pdf_combiner import combine
+from pdf_combiner import combine_pdfs
 from process_cards import generate_cards
 
 app = typer.Typer()
@@ -20,15 +20,17 @@ def main(
     ),
     show: bool = typer.Option(False, help="Show the output file in the default PDF viewer."),
 ) -> None:
+    # Each file's cards are already rendered in parallel over all cores
+    pdf_files = []
     for input_file in input_files:
-        pdf_dir = generate_cards(input_file)
+        pdf_files += sorted(generate_cards(input_file))
 
     output_file = input_file.with_name(f"{input_file.stem}_printable_cards.pdf")
-    combine(pdf_dir, output_file, four_up)
+    combine_pdfs(pdf_files, output_file, four_up, scale_a4=False)
     print(f"Printable cards saved to {output_file}")
     if show:
-        cmd = f"firefox '{output_file}'"
-        os.system(cmd)
+        # Open the viewer without a shell and without waiting for it to close
+        subprocess.Popen(["firefox", str(output_file)])
 
 
 if __name__ == "__main__":
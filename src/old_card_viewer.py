@@ -1,11 +1,11 @@
 import base64
 import glob
-import json
 import os
 from io import BytesIO
 
 import streamlit as st
 from PIL import Image
+from pydantic_core import from_json
 
 st.set_page_config(page_title="Book Cards Viewer", page_icon="📚", layout="wide")
 
@@ -17,15 +17,115 @@ def get_available_jsonl_files():
     return [os.path.basename(f) for f in glob.glob("*.jsonl")]
 
 
-def load_cards(filename):
-    cards = []
-    with open(filename, "r") as f:
-        for line in f:
-            cards.append(json.loads(line))
-    return cards
+# Number of cards rendered per page
+PAGE_SIZE = 10
+# Bounding box of the images shown in the card list
+THUMBNAIL_SIZE = (600, 600)
 
 
-def display_card(card):
+def iter_cards(filename, skipped_lines=None):
+    """Lazily yield one parsed card per line.
+
+    Malformed lines are skipped, and their 1-based numbers appended to `skipped_lines` if given.
+    """
+    with open(filename, "rb") as f:
+        for line_number, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield from_json(line)
+            except ValueError:
+                if skipped_lines is not None:
+                    skipped_lines.append(line_number)
+
+
+@st.cache_data(show_spinner=False)
+def load_cards(filename, mtime):
+    """Parse the cards once per file version. `mtime` only serves as cache key.
+
+    Returns the cards and the numbers of the malformed lines that were skipped.
+    """
+    skipped_lines = []
+    cards = list(iter_cards(filename, skipped_lines))
+    return cards, skipped_lines
+
+
+@st.cache_data(show_spinner=False)
+def build_search_index(filename, mtime):
+    """Lowercased title and description of each card, joined in one searchable string."""
+    return [
+        card["title"].lower() + "\x00" + card["description"].lower()
+        for card in load_cards(filename, mtime)[0]
+    ]
+
+
+def trigram_mask(text):
+    """64-bit signature with one bit set per trigram of the text."""
+    mask = 0
+    for i in range(len(text) - 2):
+        mask |= 1 << (hash(text[i : i + 3]) & 63)
+    return mask
+
+
+@st.cache_data(show_spinner=False)
+def build_trigram_masks(filename, mtime):
+    """Trigram signature of each entry of the search index."""
+    return [trigram_mask(text) for text in build_search_index(filename, mtime)]
+
+
+def search_cards(filename, mtime, query):
+    """Return the indices of the cards matching the query.
+
+    When the query extends the previous one, only the previous matches are rescanned.
+    """
+    index = build_search_index(filename, mtime)
+    candidates = range(len(index))
+
+    last_file, last_mtime, last_query, last_result = st.session_state.get(
+        "last_search", (None, None, None, None)
+    )
+    if (filename, mtime) == (last_file, last_mtime) and query.startswith(last_query):
+        candidates = last_result
+
+    # A card can only match if it contains all the trigrams of the query
+    masks = build_trigram_masks(filename, mtime)
+    query_mask = trigram_mask(query)
+    result = [i for i in candidates if masks[i] & query_mask == query_mask and query in index[i]]
+    st.session_state["last_search"] = (filename, mtime, query, result)
+    return result
+
+
+@st.cache_data(show_spinner=False)
+def decode_card_image(image_base64, full_size=False):
+    """Decode a base64 card image once into encoded bytes, which st.image serves as is.
+
+    Unless `full_size` is set, the image is downscaled to fit THUMBNAIL_SIZE.
+    """
+    image_bytes = base64.b64decode(image_base64)
+    return image_bytes if full_size else make_thumbnail(image_bytes)
+
+
+@st.cache_data(show_spinner=False)
+def load_card_image(image_path, mtime, full_size=False):
+    """Read a card image file once per file version. `mtime` only serves as cache key.
+
+    Unless `full_size` is set, the image is downscaled to fit THUMBNAIL_SIZE.
+    """
+    with open(image_path, "rb") as f:
+        image_bytes = f.read()
+    return image_bytes if full_size else make_thumbnail(image_bytes)
+
+
+def make_thumbnail(image_bytes):
+    """Downscale an encoded image to fit THUMBNAIL_SIZE, re-encoded as WebP."""
+    image = Image.open(BytesIO(image_bytes))
+    image.thumbnail(THUMBNAIL_SIZE, Image.Resampling.LANCZOS)
+    buffer = BytesIO()
+    image.save(buffer, format="WEBP", quality=90)
+    return buffer.getvalue()
+
+
+def display_card(card, full_size_images=False):
     col1, col2 = st.columns([1, 1])
 
     with col1:
@@ -40,7 +140,14 @@ def display_card(card):
         st.info(card["illustration"])
 
         # Show any extra fields
-        standard_fields = ["title", "description", "illustration", "quotes", "image_base64"]
+        standard_fields = [
+            "title",
+            "description",
+            "illustration",
+            "quotes",
+            "image_base64",
+            "image_path",
+        ]
         extra_fields = [field for field in card.keys() if field not in standard_fields]
 
         if extra_fields:
@@ -58,10 +165,15 @@ def display_card(card):
                     st.write(card[field])
 
     with col2:
-        if card["image_base64"] != "No image generated":
-            # Convert base64 to image
-            image_data = base64.b64decode(card["image_base64"])
-            image = Image.open(BytesIO(image_data))
+        if card.get("image_path"):
+            image_path = card["image_path"]
+            if os.path.exists(image_path):
+                image = load_card_image(image_path, os.path.getmtime(image_path), full_size_images)
+                st.image(image, use_container_width=True)
+            else:
+                st.warning(f"Image file {image_path} not found")
+        elif card.get("image_base64") and card["image_base64"] != "No image generated":
+            image = decode_card_image(card["image_base64"], full_size_images)
             st.image(image, use_container_width=True)
         else:
             st.warning("No image available for this card")
@@ -76,34 +188,43 @@ else:
     # Add file selector in sidebar
     st.sidebar.markdown("### 📁 Select Cards File")
     selected_file = st.sidebar.selectbox("Choose a JSONL file", jsonl_files, index=0)
+    full_size_images = st.sidebar.checkbox("Show full resolution images", value=False)
 
     # Load and display cards
     try:
-        cards = load_cards(selected_file)
-
         # Add a search bar
         search_query = st.text_input("🔍 Search cards by title or description", "")
+        query = search_query.lower()
 
         # Filter cards based on search
-        filtered_cards = cards
-        if search_query:
-            filtered_cards = [
-                card
-                for card in cards
-                if search_query.lower() in card["title"].lower()
-                or search_query.lower() in card["description"].lower()
-            ]
+        mtime = os.path.getmtime(selected_file)
+        cards, skipped_lines = load_cards(selected_file, mtime)
+        if skipped_lines:
+            shown_lines = ", ".join(map(str, skipped_lines[:10]))
+            more = ", ..." if len(skipped_lines) > 10 else ""
+            st.warning(
+                f"Skipped {len(skipped_lines)} malformed line(s) in {selected_file}: "
+                f"line {shown_lines}{more}"
+            )
+        filtered_indices = search_cards(selected_file, mtime, query)
+
+        # Only render the cards of the selected page
+        page_count = max(1, (len(filtered_indices) - 1) // PAGE_SIZE + 1)
+        page = st.sidebar.number_input("Page", min_value=1, max_value=page_count, value=1)
+        page_start = (page - 1) * PAGE_SIZE
+        page_indices = filtered_indices[page_start : page_start + PAGE_SIZE]
 
         # Display cards
-        for i, card in enumerate(filtered_cards):
+        for i, card_index in enumerate(page_indices, start=page_start):
+            card = cards[card_index]
             with st.expander(f"Card {i+1}: {card['title']}", expanded=True):
-                display_card(card)
+                display_card(card, full_size_images)
             st.markdown("---")
 
         # Display stats
         st.sidebar.markdown("### 📊 Stats")
         st.sidebar.write(f"Total cards: {len(cards)}")
-        st.sidebar.write(f"Filtered cards: {len(filtered_cards)}")
+        st.sidebar.write(f"Filtered cards: {len(filtered_indices)}")
 
     except FileNotFoundError:
         st.error(f"File {selected_file} not found.")
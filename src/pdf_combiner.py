@@ -1,5 +1,6 @@
+import shutil
 from pathlib import Path
-from typing import Annotated, List, Optional, Tuple
+from typing import Annotated, List, Tuple
 
 import typer
 from pypdf import PageObject, PdfReader, PdfWriter
@@ -18,9 +19,52 @@ from constants import (
 app = typer.Typer(help="Combines PDFs into printable layouts.")
 
 
+def _compute_4up_transforms() -> Tuple[Tuple[float, ...], ...]:
+    """Transforms placing four A5 pages, scaled to A6, in a 2x2 grid on an A4 landscape page."""
+    # Scale factor for A5 to A6 - increased from 0.5 to 0.65 for better readability
+    scale = 0.65
+
+    # Calculate margins and spacing
+    horizontal_spacing = 10  # Space between columns
+    vertical_spacing = 10  # Space between rows
+
+    # Calculate effective width and height after scaling
+    effective_width = A5_LANDSCAPE_WIDTH * scale
+    effective_height = A5_LANDSCAPE_HEIGHT * scale
+
+    # Calculate positions with margins to center the content
+    horizontal_margin = (A4_LANDSCAPE_WIDTH - (2 * effective_width) - horizontal_spacing) / 2
+    vertical_margin = (A4_LANDSCAPE_HEIGHT - (2 * effective_height) - vertical_spacing) / 2
+
+    positions = [
+        # Top-left
+        (horizontal_margin, A4_LANDSCAPE_HEIGHT - effective_height - vertical_margin),
+        # Top-right
+        (
+            horizontal_margin + effective_width + horizontal_spacing,
+            A4_LANDSCAPE_HEIGHT - effective_height - vertical_margin,
+        ),
+        # Bottom-left
+        (horizontal_margin, vertical_margin),
+        # Bottom-right
+        (horizontal_margin + effective_width + horizontal_spacing, vertical_margin),
+    ]
+
+    # Transform matrix: (scale_x, skew_x, skew_y, scale_y, translate_x, translate_y)
+    return tuple((scale, 0, 0, scale, pos_x, pos_y) for pos_x, pos_y in positions)
+
+
+# Page transforms of the layouts, which only depend on the page sizes
+_2UP_TRANSFORMS = (
+    (1, 0, 0, 1, 0, A4_PORTRAIT_HEIGHT - A5_LANDSCAPE_HEIGHT),  # Top half
+    (1, 0, 0, 1, 0, 0),  # Bottom half
+)
+_4UP_TRANSFORMS = _compute_4up_transforms()
+
+
 def get_pdf_files(input_dir: Path) -> List[Path]:
     """Get sorted list of PDF files from input directory."""
-    pdf_files = sorted(list(input_dir.glob("*.pdf")))
+    pdf_files = sorted(input_dir.glob("*.pdf"))
 
     if not pdf_files:
         typer.secho(f"No PDF files found in {input_dir}.", fg=typer.colors.RED)
@@ -97,137 +141,48 @@ def categorize_pdf(pdf_path: Path) -> Tuple[bool, List[PageObject]]:
         return False, []
 
 
-def process_pdf_page(pdf_path: Path) -> Optional[PageObject]:
-    """Process a single PDF file and return its first page if successful."""
-    try:
-        reader = PdfReader(str(pdf_path))
-        if len(reader.pages) != 1:
-            typer.secho(
-                f"Warning: {pdf_path.name} has {len(reader.pages)} pages. Expected 1. Using the first page.",
-                fg=typer.colors.YELLOW,
-            )
-        return reader.pages[0]
-    except PdfReadError:
-        typer.secho(f"Error reading {pdf_path.name}. Skipping this file.", fg=typer.colors.RED)
-        return None
-    except Exception as e:
-        typer.secho(
-            f"An unexpected error occurred with {pdf_path.name}: {e}. Skipping this file.",
-            fg=typer.colors.RED,
-        )
-        return None
-
-
-def create_2up_a4_page(writer: PdfWriter, pdf_paths: List[Path]) -> bool:
+def create_2up_a4_page(writer: PdfWriter, a5_pages: List[PageObject]) -> bool:
     """Create an A4 portrait page with up to two A5 landscape pages and add it to the writer.
 
     Args:
         writer: The PDF writer to add the page to
-        pdf_paths: List of up to 2 PDF paths to add to the page
+        a5_pages: List of up to 2 A5 pages, as read by categorize_pdf, to add to the page
 
     Returns:
-        bool: True if at least one page was successfully processed, False otherwise.
+        bool: True if at least one page was added, False otherwise.
     """
-    # Create a new blank A4 portrait page
-    a4_page = writer.add_blank_page(width=A4_PORTRAIT_WIDTH, height=A4_PORTRAIT_HEIGHT)
-
-    # Process the first PDF (top part of A4 page)
-    if not pdf_paths:
-        writer.pages.pop()
+    if not a5_pages:
         return False
 
-    a5_page1 = process_pdf_page(pdf_paths[0])
-    if a5_page1 is None:
-        # Remove the blank page we just added since we couldn't process the first PDF
-        writer.pages.pop()
-        return False
-
-    # Place A5 page 1 on the top half
-    offset_y_page1 = A4_PORTRAIT_HEIGHT - A5_LANDSCAPE_HEIGHT
-    a4_page.merge_transformed_page(a5_page1, (1, 0, 0, 1, 0, offset_y_page1))
-    typer.echo(f"Processed {pdf_paths[0].name} (top part)")
+    # Create a new blank A4 portrait page
+    a4_page = writer.add_blank_page(width=A4_PORTRAIT_WIDTH, height=A4_PORTRAIT_HEIGHT)
 
-    # Process the second PDF (bottom part of A4 page) if available
-    if len(pdf_paths) > 1:
-        a5_page2 = process_pdf_page(pdf_paths[1])
-        if a5_page2:
-            # Place A5 page 2 on the bottom half
-            a4_page.merge_transformed_page(a5_page2, (1, 0, 0, 1, 0, 0))
-            typer.echo(f"Processed {pdf_paths[1].name} (bottom part)")
+    # Place A5 page 1 on the top half, and A5 page 2 on the bottom half if available
+    for a5_page, transform in zip(a5_pages, _2UP_TRANSFORMS):
+        a4_page.merge_transformed_page(a5_page, transform)
 
     return True
 
 
-def create_4up_a4_page(writer: PdfWriter, pdf_paths: List[Path]) -> bool:
+def create_4up_a4_page(writer: PdfWriter, a5_pages: List[PageObject]) -> bool:
     """Create an A4 landscape page with up to four A5 pages (scaled to A6) and add it to the writer.
 
     Args:
         writer: The PDF writer to add the page to
-        pdf_paths: List of up to 4 PDF paths to add to the page
+        a5_pages: List of up to 4 A5 pages, as read by categorize_pdf, to add to the page
 
     Returns:
-        bool: True if at least one page was successfully processed, False otherwise.
+        bool: True if at least one page was added, False otherwise.
     """
-    # Create a new blank A4 landscape page
-    a4_page = writer.add_blank_page(width=A4_LANDSCAPE_WIDTH, height=A4_LANDSCAPE_HEIGHT)
-
-    # Check if we have any PDFs to process
-    if not pdf_paths:
-        writer.pages.pop()
+    if not a5_pages:
         return False
 
-    # Scale factor for A5 to A6 - increased from 0.5 to 0.65 for better readability
-    scale = 0.65
-
-    # Calculate margins and spacing
-    horizontal_spacing = 10  # Space between columns
-    vertical_spacing = 10  # Space between rows
-
-    # Calculate effective width and height after scaling
-    effective_width = A5_LANDSCAPE_WIDTH * scale
-    effective_height = A5_LANDSCAPE_HEIGHT * scale
-
-    # Calculate positions with margins to center the content
-    horizontal_margin = (A4_LANDSCAPE_WIDTH - (2 * effective_width) - horizontal_spacing) / 2
-    vertical_margin = (A4_LANDSCAPE_HEIGHT - (2 * effective_height) - vertical_spacing) / 2
-
-    # Process up to 4 PDFs
-    positions = [
-        # Top-left
-        (horizontal_margin, A4_LANDSCAPE_HEIGHT - effective_height - vertical_margin),
-        # Top-right
-        (
-            horizontal_margin + effective_width + horizontal_spacing,
-            A4_LANDSCAPE_HEIGHT - effective_height - vertical_margin,
-        ),
-        # Bottom-left
-        (horizontal_margin, vertical_margin),
-        # Bottom-right
-        (horizontal_margin + effective_width + horizontal_spacing, vertical_margin),
-    ]
-
-    success = False
-
-    for i, pdf_path in enumerate(pdf_paths[:4]):  # Limit to 4 PDFs
-        a5_page = process_pdf_page(pdf_path)
-        if a5_page is None:
-            continue
-
-        # Get position for this page
-        pos_x, pos_y = positions[i]
-
-        # Transform matrix: (scale_x, skew_x, skew_y, scale_y, translate_x, translate_y)
-        transform = (scale, 0, 0, scale, pos_x, pos_y)
+    # Create a new blank A4 landscape page
+    a4_page = writer.add_blank_page(width=A4_LANDSCAPE_WIDTH, height=A4_LANDSCAPE_HEIGHT)
 
-        # Place the scaled page at the correct position
+    # Place the scaled pages at their positions, up to 4 (zip stops at the shortest)
+    for a5_page, transform in zip(a5_pages, _4UP_TRANSFORMS):
         a4_page.merge_transformed_page(a5_page, transform)
-        typer.echo(f"Processed {pdf_path.name} (position {i+1})")
-        success = True
-
-    # If no pages were successfully processed, remove the blank page
-    if not success:
-        writer.pages.pop()
-        return False
 
     return True
 
@@ -264,8 +219,12 @@ def write_output_pdf(writer: PdfWriter, output_file: Path) -> None:
         )
         raise typer.Exit(code=1)
 
+    # Cards rendered from the same template repeat their fonts and images, store them once
+    writer.compress_identical_objects()
+
     try:
-        with open(output_file, "wb") as fp:
+        # pypdf writes object by object, buffer them into large writes
+        with open(output_file, "wb", buffering=1024 * 1024) as fp:
             writer.write(fp)
         typer.secho(f"Successfully combined PDFs into {output_file}", fg=typer.colors.GREEN)
     except Exception as e:
@@ -343,8 +302,8 @@ def combine_pdfs(pdf_files: list[Path], output_file: Path, four_up: bool, scale_
     # Create PDF writer
     writer = PdfWriter()
 
-    # Categorize PDFs into A4 and A5
-    a5_pdf_paths = []
+    # Categorize PDFs into A4 and A5, keeping the pages read so each file is opened once
+    a5_pages = []
     a4_pages = []
 
     for pdf_path in pdf_files:
@@ -352,23 +311,28 @@ def combine_pdfs(pdf_files: list[Path], output_file: Path, four_up: bool, scale_
         if is_a4:
             a4_pages.extend(pages)
         else:
-            if pages:  # Only add if we got valid pages
-                a5_pdf_paths.append(pdf_path)
+            a5_pages.extend(pages)  # Empty if the file could not be read
+
+    # A single A4 document would be written back unchanged, copy it instead.
+    # When it already is the output file, there is nothing to write
+    if len(pdf_files) == 1 and a4_pages and not scale_a4:
+        if Path(pdf_files[0]).resolve() != Path(output_file).resolve():
+            shutil.copyfile(pdf_files[0], output_file)
+        typer.secho(f"Successfully combined PDFs into {output_file}", fg=typer.colors.GREEN)
+        return output_file
 
     # Process A5 landscape PDFs
-    if a5_pdf_paths:
-        typer.secho(f"Processing {len(a5_pdf_paths)} A5 landscape PDFs...", fg=typer.colors.GREEN)
+    if a5_pages:
+        typer.secho(f"Processing {len(a5_pages)} A5 landscape PDFs...", fg=typer.colors.GREEN)
 
         if not four_up:
-            # Process PDF files in pairs
-            for i in range(0, len(a5_pdf_paths), 2):
-                pdf_paths = a5_pdf_paths[i : i + 2]
-                create_2up_a4_page(writer, pdf_paths)
+            # Process pages in pairs
+            for i in range(0, len(a5_pages), 2):
+                create_2up_a4_page(writer, a5_pages[i : i + 2])
         else:
-            # Process PDF files in groups of 4
-            for i in range(0, len(a5_pdf_paths), 4):
-                pdf_paths = a5_pdf_paths[i : i + 4]
-                create_4up_a4_page(writer, pdf_paths)
+            # Process pages in groups of 4
+            for i in range(0, len(a5_pages), 4):
+                create_4up_a4_page(writer, a5_pages[i : i + 4])
 
     # Process A4 PDFs
     if a4_pages:
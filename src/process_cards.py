@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import base64
 import json
 import os
 from io import BytesIO
@@ -10,6 +11,7 @@ import typer
 from jinja2 import Environment, FileSystemLoader, select_autoescape
 from joblib import Parallel, delayed
 from pdf2image import convert_from_bytes
+from pydantic_core import from_json
 from typing_extensions import Annotated
 from weasyprint import HTML
 
@@ -54,6 +56,30 @@ NJobsOption = Annotated[
 
 app = typer.Typer(help="CLI tool to generate PDF cards from a JSONL file and HTML template.")
 
+# Created once per worker process, which then compiles each template once and reuses it
+_TEMPLATE_ENV = Environment(
+    loader=FileSystemLoader(TEMPLATE_DIR), autoescape=select_autoescape(["html", "xml"])
+)
+
+
+def _image_mime_type(image_base64: str) -> str:
+    """MIME type of a base64 image from its signature.
+
+    Images are generated as WebP, older cache entries hold the JPG or PNG Runware sent.
+    """
+    try:
+        header = base64.b64decode(image_base64[:16])
+    except ValueError:
+        return "image/png"
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return "image/webp"
+    if header[:3] == b"\xff\xd8\xff":
+        return "image/jpeg"
+    return "image/png"
+
+
+_TEMPLATE_ENV.filters["image_mime_type"] = _image_mime_type
+
 
 def slugify(text: str) -> str:
     """Converts a string into a simplified, file-safe slug."""
@@ -65,12 +91,13 @@ def _render_template(
     template_file_name: str,
     output_dir: Path,
     title: str | None = None,
+    keep_html: bool = False,
 ) -> tuple[str, str]:
-    """Renders a template to HTML and returns (rendered_html, base_filename)."""
-    # Create a new template environment for each worker
-    file_loader = FileSystemLoader(TEMPLATE_DIR)
-    env = Environment(loader=file_loader, autoescape=select_autoescape(["html", "xml"]))
-    template = env.get_template(template_file_name)
+    """Renders a template to HTML and returns (rendered_html, base_filename).
+
+    The HTML is also saved next to the other outputs if keep_html is set.
+    """
+    template = _TEMPLATE_ENV.get_template(template_file_name)
 
     if title is None:
         card_title = template_data.get("title", template_data.get("section_name", "toc"))
@@ -92,9 +119,9 @@ def _render_template(
 
     rendered_html = template.render(template_data)
 
-    # Save HTML file
-    html_file_path = output_dir / f"{base_filename}.html"
-    html_file_path.write_text(rendered_html, encoding="utf-8")
+    if keep_html:
+        html_file_path = output_dir / f"{base_filename}.html"
+        html_file_path.write_text(rendered_html, encoding="utf-8")
 
     return rendered_html, base_filename
 
@@ -104,10 +131,11 @@ def create_pdf(
     template_file_name: str,
     output_dir: Path,
     title: str | None = None,
+    keep_html: bool = False,
 ) -> Path:
     """Renders a single card from data to HTML and then to PDF."""
     rendered_html, base_filename = _render_template(
-        template_data, template_file_name, output_dir, title
+        template_data, template_file_name, output_dir, title, keep_html
     )
 
     pdf_file_path = output_dir / f"{base_filename}.pdf"
@@ -163,6 +191,21 @@ def create_png_multipage(
     return png_paths
 
 
+def _load_cards_data(input_file: Path) -> list[Dict[str, Any]]:
+    """Reads the cards of a JSON Lines file, resolving sidecar image paths to file URIs."""
+    cards_data = []
+    with input_file.open("rb") as f_in:
+        for line in f_in:
+            line_content = line.strip()
+            if not line_content:
+                continue
+            card = from_json(line_content)
+            if card.get("image_path"):
+                card["image_uri"] = (input_file.parent / card["image_path"]).resolve().as_uri()
+            cards_data.append(card)
+    return cards_data
+
+
 def _process_cards_parallel(
     cards_data: list[Dict[str, Any]],
     template_filename: str,
@@ -209,13 +252,7 @@ def generate_cards(input_file: JsonLinesInputFile, n_jobs: NJobsOption = None) -
     """Processes a JSON Lines file to generate HTML cards and convert them to PDF."""
     output_dir = input_file.parent / (input_file.stem + "_output")
 
-    cards_data = []
-    with input_file.open("r", encoding="utf-8") as f_in:
-        for i, line in enumerate(f_in):
-            line_content = line.strip()
-            if not line_content:
-                continue
-            cards_data.append(json.loads(line_content))
+    cards_data = _load_cards_data(input_file)
 
     return _process_cards_parallel(cards_data, CARD_TEMPLATE_FILENAME, output_dir, n_jobs)
 
@@ -239,7 +276,10 @@ def generate_toc(json_structure: JsonInputFile) -> Path:
     output_dir.mkdir(exist_ok=True)
 
     book_structure = json.loads(json_structure.read_text(encoding="utf-8"))
-    return create_pdf(book_structure, TOC_TEMPLATE_FILENAME, output_dir, title="toc")
+    # The web app offers the TOC HTML for download
+    return create_pdf(
+        book_structure, TOC_TEMPLATE_FILENAME, output_dir, title="toc", keep_html=True
+    )
 
 
 # PNG generation functions for ZIP output
@@ -249,13 +289,7 @@ def generate_cards_as_png(input_file: Path, n_jobs: int | None = None) -> list[P
     """Processes a JSON Lines file to generate HTML cards and convert them to PNG."""
     output_dir = input_file.parent / (input_file.stem + "_output")
 
-    cards_data = []
-    with input_file.open("r", encoding="utf-8") as f_in:
-        for line in f_in:
-            line_content = line.strip()
-            if not line_content:
-                continue
-            cards_data.append(json.loads(line_content))
+    cards_data = _load_cards_data(input_file)
 
     return _process_cards_parallel(cards_data, CARD_TEMPLATE_FILENAME, output_dir, n_jobs, "png")
 
@@ -10,12 +10,14 @@ from dotenv import load_dotenv
 from pydantic import BaseModel
 from streamlit_pdf_viewer import pdf_viewer
 
+from api_cache import ImageClients
 from constants import MODEL_NAME
 from src.book_to_cards import (
     CardSet,
     analyze_book_structure,
+    generate_card_images,
     generate_cards_from_sections,
-    generate_images_for_game,
+    generate_landscape_images,
     save_game_data,
 )
 from src.clean_epub import convert_epub_to_html, convert_html_to_clean_html
@@ -154,16 +156,31 @@ async def processing_phase(state: State):
             print("Analyzing book structure")
             structure = analyze_book_structure(cleaned_html)
 
-            if not state.toc_only:
-                print("Generating cards")
-                cards = await generate_cards_from_sections(
-                    cleaned_html, structure, state.total_cards
-                )
-            else:
-                cards = CardSet(card_definitions=[], language=structure.language)
-
-            if state.generate_images:
-                cards, structure = await generate_images_for_game(cards, structure)
+            # Both image batches share one Runware connection and HTTP session
+            async with ImageClients() as clients:
+                # Landscapes only need the structure, generate them while the cards are written
+                landscapes_task = None
+                if state.generate_images:
+                    landscapes_task = asyncio.create_task(
+                        generate_landscape_images(structure, clients)
+                    )
+
+                try:
+                    if not state.toc_only:
+                        print("Generating cards")
+                        cards = await generate_cards_from_sections(
+                            cleaned_html, structure, state.total_cards
+                        )
+                    else:
+                        cards = CardSet(card_definitions=[], language=structure.language)
+
+                    if landscapes_task is not None:
+                        await asyncio.gather(generate_card_images(cards, clients), landscapes_task)
+                finally:
+                    # Don't leave the landscapes running on clients about to be closed
+                    if landscapes_task is not None and not landscapes_task.done():
+                        landscapes_task.cancel()
+                        await asyncio.gather(landscapes_task, return_exceptions=True)
 
             cards_file, structure_file = save_game_data(
                 cards, structure, state.work_dir / f"{state.input_file.stem}_game"
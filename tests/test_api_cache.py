@@ -0,0 +1,76 @@
+from pathlib import Path
+
+import pytest
+from pydantic_core import from_json, to_json
+
+from src import api_cache
+from src.api_cache import (
+    _cache_path,
+    _load_cached_image,
+    _save_cached_image,
+    _save_cached_response,
+    clear_cache,
+    get_cache_stats,
+)
+
+
+@pytest.fixture
+def cache_dir(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> Path:
+    """Fixture pointing the API cache at an empty temporary directory"""
+    monkeypatch.setattr(api_cache, "CACHE_DIR", tmp_path)
+    monkeypatch.setattr(api_cache, "CLEAN_HTML_CACHE_DIR", tmp_path / "clean_html")
+    monkeypatch.setattr(api_cache, "DISABLE_CACHE", False)
+    return tmp_path
+
+
+def test_cache_path_migrates_flat_entries(cache_dir: Path):
+    """Test that entries written before sharding are moved into their shard on first access."""
+    key = "ab12cd34ef56ab78"
+    flat_file = cache_dir / f"completion_{key}.json"
+    flat_file.write_bytes(b'{"output": "cached"}')
+
+    cache_file = _cache_path("completion", key)
+
+    assert cache_file == cache_dir / "ab" / flat_file.name, "Entry should be sharded by key"
+    assert not flat_file.exists(), "Flat entry should have been moved"
+    assert from_json(cache_file.read_bytes()) == {"output": "cached"}
+
+    new_file = _cache_path("completion", "cd12cd34ef56ab78")
+    assert new_file == cache_dir / "cd" / "completion_cd12cd34ef56ab78.json"
+    assert not new_file.parent.exists(), "Looking up a missing entry should create nothing"
+
+
+def test_cached_image_round_trip(cache_dir: Path):
+    """Test that images are cached in a base64 sidecar, and legacy inline entries still load."""
+    cache_file = _cache_path("image", "ab12cd34ef56ab78")
+    assert _load_cached_image(cache_file) is None, "Missing entry should not load"
+
+    _save_cached_image(cache_file, ("A prompt", (64, 64), "model"), "aW1hZ2U=")
+
+    image_file = cache_file.with_suffix(".b64")
+    assert image_file.read_bytes() == b"aW1hZ2U="
+    cached_data = from_json(cache_file.read_bytes())
+    assert cached_data["output_file"] == image_file.name, "Stub should point to the sidecar"
+    assert "output" not in cached_data, "Image should not be inlined in the stub"
+    assert _load_cached_image(cache_file) == "aW1hZ2U="
+
+    legacy_file = _cache_path("image", "cd12cd34ef56ab78")
+    legacy_file.parent.mkdir()
+    legacy_file.write_bytes(to_json({"args": [], "kwargs": {}, "output": "bGVnYWN5"}))
+    assert _load_cached_image(legacy_file) == "bGVnYWN5"
+
+
+def test_get_cache_stats_and_clear_cache(cache_dir: Path):
+    """Test that cache entries are counted across shards, and cleared with their shards."""
+    _save_cached_response(_cache_path("completion", "ab12cd34ef56ab78"), {"output": 1})
+    _save_cached_response(_cache_path("acompletion", "cd12cd34ef56ab78"), {"output": 2})
+    _save_cached_image(_cache_path("image", "ef12cd34ef56ab78"), ("A prompt",), "aW1hZ2U=")
+    (cache_dir / "clean_html" / "0123456789abcdef" / "media").mkdir(parents=True)
+    (cache_dir / "clean_html" / ".staging_abc").mkdir()
+
+    assert get_cache_stats() == {"total_cached": 4, "completions": 2, "images": 1, "clean_html": 1}
+
+    clear_cache()
+
+    assert not any(cache_dir.iterdir()), "Entries, sidecars and shards should all be removed"
+    assert get_cache_stats() == {"total_cached": 0, "completions": 0, "images": 0, "clean_html": 0}
@@ -1,12 +1,28 @@
+import base64
 import copy
+from io import BytesIO
 from pathlib import Path
 
 import pytest
+from PIL import Image
+from pydantic_core import from_json
 
+from constants import NO_IMAGE_PLACEHOLDER
 from src.book_to_cards import (
+    BookStructure,
+    Card,
+    CardSet,
+    Chapter,
+    Section,
+    SectionColor,
+    _build_tag_index,
+    _find_tag_start,
+    _image_suffix,
+    _split_book_into_sections,
     analyze_book_structure,
     generate_cards_from_sections,
     generate_images_for_game,
+    save_game_data,
 )
 
 
@@ -223,3 +239,137 @@ async def test_generate_images_for_game():
     print(
         f"✓ Test passed with {len(updated_cards.card_definitions)} card images and {len(updated_structure.sections)} section images generated"
     )
+
+
+def _save_test_game(tmp_path: Path) -> tuple[Path, Path, bytes]:
+    """Save a card with an image and a placeholder card, returning the files and image bytes."""
+    buffer = BytesIO()
+    Image.new("RGB", (8, 8), "red").save(buffer, format="WEBP")
+    image_bytes = buffer.getvalue()
+
+    card_fields = {
+        "description": "A description.",
+        "illustration": "An illustration.",
+        "quotes": ["A quote."],
+        "card_type": "concept",
+        "card_color": "#1A2B3C",
+    }
+    cards = CardSet(
+        language="English",
+        card_definitions=[
+            Card(
+                title="With image",
+                image_base64=base64.b64encode(image_bytes).decode(),
+                **card_fields,
+            ),
+            Card(title="Placeholder", image_base64=NO_IMAGE_PLACEHOLDER, **card_fields),
+        ],
+    )
+    structure = BookStructure(
+        language="English", title="Book", author="Author", year="2000", sections=[]
+    )
+
+    cards_file, structure_file = save_game_data(cards, structure, tmp_path / "book_game")
+    return cards_file, structure_file, image_bytes
+
+
+def test_save_game_data(tmp_path: Path):
+    """Test that card images are saved as sidecar files referenced relative to the JSONL."""
+    cards_file, structure_file, image_bytes = _save_test_game(tmp_path)
+
+    saved_cards = [from_json(line) for line in cards_file.read_bytes().splitlines()]
+    assert len(saved_cards) == 2, "Should save one line per card"
+    assert "image_base64" not in saved_cards[0], "Image should not be inlined in the JSONL"
+    assert (
+        saved_cards[0]["image_path"] == "book_game_images/card_000.webp"
+    ), "Path should be relative"
+    assert (tmp_path / saved_cards[0]["image_path"]).read_bytes() == image_bytes
+    assert "image_path" not in saved_cards[1], "Placeholder card should get no image path"
+    assert structure_file.exists(), "Book structure should be saved"
+
+
+def test_load_cards_data_image_uri(tmp_path: Path):
+    """Test that the sidecar image paths of saved cards are resolved to file URIs."""
+    # process_cards needs the rendering dependencies, such as weasyprint
+    process_cards = pytest.importorskip("src.process_cards")
+    cards_file, _, _ = _save_test_game(tmp_path)
+
+    cards_data = process_cards._load_cards_data(cards_file)
+    assert (
+        cards_data[0]["image_uri"]
+        == (tmp_path / "book_game_images" / "card_000.webp").resolve().as_uri()
+    )
+    assert "image_uri" not in cards_data[1], "Placeholder card should get no image URI"
+
+
+def test_image_suffix():
+    """Test that sidecar images get the extension of their actual format."""
+
+    test_cases = [
+        # (image_format, expected_suffix)
+        ("WEBP", ".webp"),
+        ("JPEG", ".jpg"),
+        ("PNG", ".png"),
+    ]
+
+    for image_format, expected in test_cases:
+        buffer = BytesIO()
+        Image.new("RGB", (8, 8), "red").save(buffer, format=image_format)
+        assert _image_suffix(buffer.getvalue()) == expected, f"Failed for {image_format}"
+
+
+def test_build_tag_index():
+    """Test that each tag id maps to its first id attribute, without prefix confusion."""
+    book_html = '<p id="tag-12">Twelve</p><p id="tag-1">One</p><span id="tag-1">Again</span>'
+
+    tag_index = _build_tag_index(book_html)
+
+    assert tag_index["tag-1"] == book_html.index('id="tag-1"'), "tag-1 should not match tag-12"
+    assert tag_index["tag-12"] == book_html.index('id="tag-12"')
+    assert "tag-2" not in tag_index, "Missing tags should not be indexed"
+
+
+def test_find_tag_start():
+    """Test that the start of the tag holding an id attribute is found."""
+    book_html = 'Text <p id="tag-1">One</p>'
+    tag_start = book_html.index("<p")
+
+    assert _find_tag_start(book_html, book_html.index('id="tag-1"')) == tag_start
+    assert _find_tag_start(book_html, tag_start) == tag_start, "A < at idx should be found"
+    assert _find_tag_start('Text id="tag-1"', 8) == 0, "Should fall back to 0 without any <"
+
+
+def _make_structure(start_tag: str, end_tag: str) -> BookStructure:
+    """Book structure with a single section spanning one chapter between the given tags."""
+    chapter = Chapter(
+        chapter_name="Chapter",
+        chapter_comment="A chapter.",
+        chapter_start_tag=start_tag,
+        chapter_end_tag=end_tag,
+        key_quotes=[],
+    )
+    section = Section(
+        section_name="Section",
+        section_introduction="A section.",
+        section_color=SectionColor(name="Blue", html_color="#0000FF"),
+        key_passages=[],
+        visual_landscape_description="A landscape.",
+        chapters=[chapter],
+        image_base64="",
+    )
+    return BookStructure(
+        language="English", title="Book", author="Author", year="2000", sections=[section]
+    )
+
+
+def test_split_book_into_sections():
+    """Test that sections span their chapter tags, and that invalid tags raise."""
+    book_html = '<p id="tag-1">One</p><p id="tag-2">Two</p><p id="tag-3">Three</p>'
+
+    sections = _split_book_into_sections(book_html, _make_structure("tag-1", "tag-2"))
+    assert sections == ['id="tag-1">One</p><p id="tag-2"']
+
+    with pytest.raises(ValueError):
+        _split_book_into_sections(book_html, _make_structure("tag-4", "tag-2"))
+    with pytest.raises(ValueError):
+        _split_book_into_sections(book_html, _make_structure("tag-3", "tag-1"))
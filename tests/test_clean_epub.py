@@ -1,11 +1,13 @@
 import difflib
 import shutil
+import subprocess
 import tempfile
 from pathlib import Path
 
 import pytest
 
-from src.clean_epub import convert_epub_to_html, normalize_image_paths
+from src import clean_epub
+from src.clean_epub import _link_media, convert_epub_to_html, normalize_image_paths
 
 
 @pytest.fixture
@@ -16,9 +18,12 @@ def test_epub() -> Path:
     return epub_path
 
 
-def test_convert_epub_to_html_deterministic(test_epub: Path):
+def test_convert_epub_to_html_deterministic(test_epub: Path, monkeypatch: pytest.MonkeyPatch):
     """Test that the same EPUB produces identical HTML content regardless of processing location."""
 
+    # Both conversions must run pandoc, rather than the second one reading the first from cache
+    monkeypatch.setattr(clean_epub, "DISABLE_CACHE", True)
+
     # Create two temporary directories and copy the EPUB with different filenames
     with tempfile.TemporaryDirectory() as temp_dir1, tempfile.TemporaryDirectory() as temp_dir2:
         temp_path1 = Path(temp_dir1)
@@ -76,3 +81,96 @@ def test_normalize_image_paths():
     for input_html, expected in test_cases:
         result = normalize_image_paths(input_html)
         assert result == expected, f"Failed for input: {input_html}"
+
+
+@pytest.fixture
+def fake_pandoc(tmp_path: Path, monkeypatch: pytest.MonkeyPatch) -> list[list[str]]:
+    """Fixture caching cleaned HTML in tmp_path and replacing pandoc, returning its calls"""
+    monkeypatch.setattr(clean_epub, "CLEAN_HTML_CACHE_DIR", tmp_path / "cache")
+    monkeypatch.setattr(clean_epub, "DISABLE_CACHE", False)
+    monkeypatch.setattr(clean_epub, "_pandoc_version", lambda: b"pandoc 3.0")
+
+    calls = []
+
+    def run(command, **kwargs):
+        calls.append(command)
+        media_dir = Path(command[command.index("--extract-media") + 1]) / "media"
+        media_dir.mkdir(parents=True)
+        (media_dir / "cover.png").write_bytes(b"cover")
+        html = f'<html><body><p>Text <img src="{media_dir}/cover.png"></p></body></html>'
+        return subprocess.CompletedProcess(command, 0, stdout=html)
+
+    monkeypatch.setattr(clean_epub.subprocess, "run", run)
+    return calls
+
+
+def test_convert_epub_to_html_cache(tmp_path: Path, fake_pandoc: list[list[str]]):
+    """Test that converting the same EPUB again reuses the cached HTML and links its media."""
+    epub = tmp_path / "book.epub"
+    epub.write_bytes(b"epub")
+
+    first_html = convert_epub_to_html(epub, tmp_path / "first.html", tmp_path / "first_media")
+    assert len(fake_pandoc) == 1, "First conversion should run pandoc"
+
+    (entry_dir,) = (tmp_path / "cache").iterdir()
+    assert not entry_dir.name.startswith("."), "Staging directory should have been promoted"
+    cached_cover = entry_dir / "media" / "media" / "cover.png"
+    first_cover = tmp_path / "first_media" / "media" / "cover.png"
+    assert first_cover.read_bytes() == b"cover"
+    assert first_cover.stat().st_ino == cached_cover.stat().st_ino, "Media should be hard linked"
+
+    second_html = convert_epub_to_html(epub, tmp_path / "second.html", tmp_path / "second_media")
+    assert len(fake_pandoc) == 1, "Second conversion should be a cache hit"
+    assert second_html.read_text() == first_html.read_text()
+    second_cover = tmp_path / "second_media" / "media" / "cover.png"
+    assert second_cover.stat().st_ino == cached_cover.stat().st_ino, "Media should be hard linked"
+
+    # An entry missing its HTML is a miss, and gets replaced
+    (entry_dir / "clean.html").unlink()
+    convert_epub_to_html(epub, tmp_path / "third.html", tmp_path / "third_media")
+    assert len(fake_pandoc) == 2, "Partial entry should be converted again"
+    assert (entry_dir / "clean.html").read_text() == first_html.read_text()
+
+    epub.write_bytes(b"other epub")
+    convert_epub_to_html(epub, tmp_path / "fourth.html", tmp_path / "fourth_media")
+    assert len(fake_pandoc) == 3, "A different EPUB should be a cache miss"
+    assert len(list((tmp_path / "cache").iterdir())) == 2, "Each EPUB should get its entry"
+
+
+def test_link_media(tmp_path: Path):
+    """Test that cached media is hard linked over stale files, and a missing source is reported."""
+    cached_media_dir = tmp_path / "cached"
+    (cached_media_dir / "images").mkdir(parents=True)
+    (cached_media_dir / "cover.png").write_bytes(b"cover")
+    (cached_media_dir / "images" / "figure.png").write_bytes(b"figure")
+    extract_media_dir = tmp_path / "extracted"
+    extract_media_dir.mkdir()
+    (extract_media_dir / "cover.png").write_bytes(b"stale")
+
+    assert _link_media(cached_media_dir, extract_media_dir)
+    for relative_path in ["cover.png", "images/figure.png"]:
+        cached_file = cached_media_dir / relative_path
+        extracted_file = extract_media_dir / relative_path
+        assert extracted_file.read_bytes() == cached_file.read_bytes()
+        assert extracted_file.stat().st_ino == cached_file.stat().st_ino, "Should be hard linked"
+
+    assert not _link_media(tmp_path / "missing", extract_media_dir), "Missing source should fail"
+
+
+def test_convert_epub_to_html_cache_media_removed(
+    tmp_path: Path, fake_pandoc: list[list[str]], monkeypatch: pytest.MonkeyPatch
+):
+    """Test that an entry losing its media while being read is converted again."""
+    epub = tmp_path / "book.epub"
+    epub.write_bytes(b"epub")
+    convert_epub_to_html(epub, tmp_path / "first.html", tmp_path / "first_media")
+
+    # The media disappears after the entry was found complete, as when the cache is cleared
+    (entry_dir,) = (tmp_path / "cache").iterdir()
+    shutil.rmtree(entry_dir / "media")
+    monkeypatch.setattr(clean_epub, "_is_complete_entry", lambda entry_dir: True)
+
+    html = convert_epub_to_html(epub, tmp_path / "second.html", tmp_path / "second_media")
+    assert len(fake_pandoc) == 2, "Entry without media should be converted again"
+    assert html.read_text() == (tmp_path / "first.html").read_text()
+    assert (tmp_path / "second_media" / "media" / "cover.png").read_bytes() == b"cover"